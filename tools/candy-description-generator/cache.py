@@ -0,0 +1,31 @@
+"""Local SQLite cache of generated descriptions, keyed on a hash of the full prompt."""
+
+import sqlite3
+import time
+
+import config
+
+_conn = None
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(config.CACHE_PATH)
+        # WAL lets concurrent readers proceed while a write is committing
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v TEXT, ts INTEGER)")
+    return _conn
+
+
+def get(key: str) -> str | None:
+    """Return the cached value for key, or None on a miss."""
+    row = _connect().execute("SELECT v FROM cache WHERE k = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set(key: str, value: str):
+    """Store value under key, replacing any previous entry."""
+    conn = _connect()
+    conn.execute("INSERT OR REPLACE INTO cache(k, v, ts) VALUES (?, ?, ?)", (key, value, int(time.time())))
+    conn.commit()
@@ -1,13 +1,21 @@
 """Configuration for candy description generator."""
 
 import os
+from functools import lru_cache
 
 # Claude API settings
 API_MODEL = "claude-sonnet-4-20250514"
 API_MAX_TOKENS = 300
+API_TIMEOUT_SECONDS = 60.0
 
-# Rate limiting
-REQUESTS_PER_SECOND = 1  # Conservative: 1 req/sec (~80 min for 5000 products)
+# Concurrency for live requests (--limit / --live runs)
+MAX_CONCURRENCY = 8  # Max in-flight requests; fits Tier 1 RPM
+MAX_RETRIES = 5  # Retries on 429/overloaded, backing off 2**attempt seconds (or Retry-After)
+TPM_LIMIT = 30000  # Input + output tokens per rolling minute; match your API tier
+IMAGE_TOKEN_ESTIMATE = 1500  # Approximate input tokens per product image
+
+# Message Batches API: full runs are submitted as one batch job and polled
+BATCH_POLL_SECONDS = 30
 
 # Batch / checkpoint settings
 SAVE_EVERY_N = 10  # Save progress every N products
@@ -15,6 +23,7 @@ SAVE_EVERY_N = 10  # Save progress every N products
 # File paths
 INPUT_DIR = os.path.join(os.path.dirname(__file__), "input")
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+CACHE_PATH = os.path.join(os.path.dirname(__file__), "cache.sqlite3")  # Response cache (delete to clear)
 
 # Default file names (can be overridden via CLI)
 DEFAULT_INPUT_FILE = "products.csv"
@@ -23,4 +32,17 @@ DEFAULT_OUTPUT_FILE = "products_with_descriptions.csv"
 # API key - read from environment variable
 # Set via: export ANTHROPIC_API_KEY="your-key-here"
 # Or place in a .env file in this directory
-ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
+@lru_cache(maxsize=1)
+def load_api_key() -> str:
+    """Return the API key from the environment, falling back to .env (parsed once)."""
+    api_key = os.environ.get("ANTHROPIC_API_KEY", "")
+    if api_key:
+        return api_key
+    env_path = os.path.join(os.path.dirname(__file__), ".env")
+    if os.path.exists(env_path):
+        with open(env_path) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("ANTHROPIC_API_KEY="):
+                    return line.split("=", 1)[1].strip().strip('"').strip("'")
+    return ""
@@ -3,13 +3,17 @@
 Candy product description generator using Claude API with image analysis.
 
 Usage:
-    # Test on first 50 products
+    # Test on first 50 products (concurrent live requests)
     python generate.py --limit 50
 
-    # Process all products
+    # Process all products (submitted as one Message Batches job)
     python generate.py
 
-    # Resume from where you left off (auto-detected from output file)
+    # Process all products with concurrent live requests instead of a batch job
+    python generate.py --live
+
+    # Resume from where you left off (auto-detected from output file). An interrupted
+    # batch run reattaches to its job via the saved <output>.batch id file.
     python generate.py --resume
 
     # Custom input/output files
@@ -17,22 +21,105 @@ Usage:
 """
 
 import argparse
+import asyncio
 import csv
+import hashlib
+import itertools
 import os
 import sys
 import time
+from collections import deque
+from collections.abc import Iterable, Iterator
 
 import anthropic
+import httpx
+from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
+from anthropic.types.messages.batch_create_params import Request
 
+import cache
 import config
 from prompt_template import SYSTEM_PROMPT, build_user_prompt
 
+# Mark the shared system prompt for Anthropic prompt caching; it is identical on every request
+SYSTEM_BLOCKS = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+
+class TokenBudgetTracker:
+    """Rolling 60-second token budget shared by all concurrent requests."""
+
+    WINDOW_SECONDS = 60
+
+    def __init__(self, tpm_limit: int):
+        self.tpm_limit = tpm_limit
+        self._usage = deque()  # [timestamp, tokens] entries, oldest first
+        self._total = 0
+        self._lock = asyncio.Lock()
+
+    def _prune(self, now: float):
+        while self._usage and now - self._usage[0][0] >= self.WINDOW_SECONDS:
+            self._total -= self._usage.popleft()[1]
+
+    def record_usage(self, tokens: int, reservation: list | None = None):
+        """Record real token usage, replacing the estimate in the reservation from wait_for_capacity."""
+        now = time.monotonic()
+        self._prune(now)
+        if reservation is not None and now - reservation[0] < self.WINDOW_SECONDS:
+            # Still in the window: correct the reserved entry in place so it expires as one
+            self._total += tokens - reservation[1]
+            reservation[1] = tokens
+        else:
+            # Reservation already aged out (e.g. after long backoff); count usage as of now
+            self._usage.append([now, tokens])
+            self._total += tokens
+
+    async def wait_for_capacity(self, est_tokens: int) -> list:
+        """Wait until est_tokens fits in the rolling window, then reserve it and return the reservation."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._prune(now)
+                if not self._usage or self._total + est_tokens <= self.tpm_limit:
+                    reservation = [now, est_tokens]
+                    self._usage.append(reservation)
+                    self._total += est_tokens
+                    return reservation
+                await asyncio.sleep(self.WINDOW_SECONDS - (now - self._usage[0][0]))
+
+
+def cache_key(row: dict) -> str:
+    """Hash everything that determines the model output for a row."""
+    user_text = build_user_prompt(row)
+    image_url = (row.get("Image Src") or "").strip()
+    return hashlib.sha256((SYSTEM_PROMPT + user_text + image_url + config.API_MODEL).encode()).hexdigest()
+
+
+def estimate_tokens(row: dict) -> int:
+    """Rough token estimate for one request: ~4 chars/token plus a flat cost per image."""
+    text_tokens = (len(SYSTEM_PROMPT) + len(build_user_prompt(row))) // 4
+    image_tokens = config.IMAGE_TOKEN_ESTIMATE if (row.get("Image Src") or "").strip() else 0
+    return text_tokens + image_tokens + config.API_MAX_TOKENS
+
 
-def load_input_csv(filepath: str) -> list[dict]:
-    """Load the input CSV and return list of row dicts."""
+def read_fieldnames(filepath: str) -> list[str]:
+    """Read just the header row of the input CSV."""
     with open(filepath, newline="", encoding="utf-8-sig") as f:
-        reader = csv.DictReader(f)
-        return list(reader)
+        return list(csv.DictReader(f).fieldnames or [])
+
+
+def load_input_csv(filepath: str) -> Iterator[dict]:
+    """Stream row dicts from the input CSV; the file stays open until the rows are consumed."""
+    with open(filepath, newline="", encoding="utf-8-sig") as f:
+        yield from csv.DictReader(f)
+
+
+def iter_pending(rows: Iterable[dict], completed_skus: set[str], stats: dict) -> Iterator[tuple[int, dict]]:
+    """Yield (row index, row) for rows not already completed, counting skips in stats["skipped"]."""
+    for i, row in enumerate(rows):
+        sku = (row.get("Variant SKU") or "").strip()
+        if sku in completed_skus:
+            stats["skipped"] += 1
+            continue
+        yield i, row
 
 
 def load_completed_skus(filepath: str) -> set[str]:
@@ -49,20 +136,21 @@ def load_completed_skus(filepath: str) -> set[str]:
     return completed
 
 
+_EXT_MEDIA_TYPES = {".png": "image/png", ".gif": "image/gif", ".webp": "image/webp"}
+
+
 def get_image_media_type(url: str) -> str:
     """Guess media type from URL extension."""
-    lower = url.lower().split("?")[0]
-    if lower.endswith(".png"):
-        return "image/png"
-    if lower.endswith(".gif"):
-        return "image/gif"
-    if lower.endswith(".webp"):
-        return "image/webp"
-    return "image/jpeg"
-
-
-def generate_description(client: anthropic.Anthropic, row: dict) -> str:
-    """Call Claude API with image + text prompt for a single product."""
+    # Lowercase only the last 5 chars of the path instead of copying the whole URL
+    end = url.find("?")
+    if end == -1:
+        end = len(url)
+    tail = url[max(end - 5, 0):end].lower()
+    return _EXT_MEDIA_TYPES.get(tail[-4:]) or _EXT_MEDIA_TYPES.get(tail, "image/jpeg")
+
+
+def build_message_content(row: dict) -> list[dict]:
+    """Build the image + text content blocks for a single product."""
     user_text = build_user_prompt(row)
     image_url = (row.get("Image Src") or "").strip()
 
@@ -81,30 +169,318 @@ def generate_description(client: anthropic.Anthropic, row: dict) -> str:
 
     content.append({"type": "text", "text": user_text})
 
-    message = client.messages.create(
-        model=config.API_MODEL,
-        max_tokens=config.API_MAX_TOKENS,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": content}],
-    )
+    return content
 
-    return message.content[0].text.strip()
 
-
-def init_output_csv(filepath: str, fieldnames: list[str]):
+async def call_with_backoff(make_request):
+    """Await make_request(), retrying rate-limit, overload and connection errors with exponential backoff."""
+    for attempt in range(config.MAX_RETRIES + 1):
+        try:
+            return await make_request()
+        except (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError) as e:
+            if attempt == config.MAX_RETRIES:
+                raise
+            retry_after = 0.0
+            if isinstance(e, anthropic.APIStatusError):
+                try:
+                    retry_after = float(e.response.headers.get("retry-after", "0"))
+                except ValueError:
+                    pass
+            await asyncio.sleep(max(retry_after, 2**attempt))
+
+
+async def generate_description(client: anthropic.AsyncAnthropic, tracker: TokenBudgetTracker, row: dict) -> str:
+    """Call Claude API with image + text prompt for a single product (cached on the prompt hash)."""
+    key = cache_key(row)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    content = build_message_content(row)
+    reservation = await tracker.wait_for_capacity(estimate_tokens(row))
+
+    message = await call_with_backoff(
+        lambda: client.messages.create(
+            model=config.API_MODEL,
+            max_tokens=config.API_MAX_TOKENS,
+            system=SYSTEM_BLOCKS,
+            messages=[{"role": "user", "content": content}],
+        )
+    )
+    tracker.record_usage(message.usage.input_tokens + message.usage.output_tokens, reservation)
+
+    description = message.content[0].text.strip()
+    cache.set(key, description)
+    return description
+
+
+def build_batch_requests(keyed_rows: list[tuple[str, dict]]) -> list[Request]:
+    """Build one Message Batches request per product, keyed by its prompt hash.
+
+    Using cache_key(row) as custom_id makes results self-validating: entries from
+    a stale batch (submitted for a different input) simply don't match any row.
+    """
+    return [
+        Request(
+            custom_id=key,
+            params=MessageCreateParamsNonStreaming(
+                model=config.API_MODEL,
+                max_tokens=config.API_MAX_TOKENS,
+                system=SYSTEM_BLOCKS,
+                messages=[{"role": "user", "content": build_message_content(row)}],
+            ),
+        )
+        for key, row in keyed_rows
+    ]
+
+
+async def run_batch(
+    client: anthropic.AsyncAnthropic,
+    requests: list[Request],
+    batch_id_path: str,
+) -> dict[str, tuple[str, str]]:
+    """Submit a Message Batches job, wait for it to end, and return {custom_id: (description, status)}.
+
+    The batch id is saved to batch_id_path as soon as the job is created, and an
+    interrupted run reattaches to that (already paid-for) job instead of resubmitting.
+    """
+    batch = None
+    if os.path.exists(batch_id_path):
+        with open(batch_id_path) as f:
+            batch_id = f.read().strip()
+        try:
+            batch = await call_with_backoff(lambda: client.messages.batches.retrieve(batch_id))
+            print(f"Reattached to batch {batch.id} ({batch.processing_status}) from {batch_id_path}")
+        except anthropic.NotFoundError:
+            print(f"Saved batch {batch_id} no longer exists, submitting a new batch")
+    if batch is None:
+        batch = await call_with_backoff(lambda: client.messages.batches.create(requests=requests))
+        with open(batch_id_path, "w") as f:
+            f.write(batch.id)
+        print(f"Submitted batch {batch.id} with {len(requests)} requests (id saved to {batch_id_path})")
+
+    while batch.processing_status != "ended":
+        await asyncio.sleep(config.BATCH_POLL_SECONDS)
+        batch = await call_with_backoff(lambda: client.messages.batches.retrieve(batch.id))
+        counts = batch.request_counts
+        done = counts.succeeded + counts.errored + counts.canceled + counts.expired
+        print(f"  -- Batch {batch.processing_status}: {done}/{done + counts.processing} finished")
+
+    results = {}
+    async for entry in await call_with_backoff(lambda: client.messages.batches.results(batch.id)):
+        result = entry.result
+        if result.type == "succeeded":
+            results[entry.custom_id] = (result.message.content[0].text.strip(), "success")
+        elif result.type == "errored":
+            results[entry.custom_id] = ("", f"error: {result.error.error.message}")
+        else:
+            results[entry.custom_id] = ("", f"error: request {result.type}")
+    return results
+
+
+def init_output_csv(filepath: str, fieldnames: tuple[str, ...]):
     """Create the output CSV with headers if it doesn't exist."""
     if not os.path.exists(filepath):
         with open(filepath, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
+            csv.writer(f).writerow(fieldnames)
+
+
+def write_checkpoint(out_f, writer, fieldnames: tuple[str, ...], rows: list[dict]):
+    """Append processed rows to the open output CSV and force them to disk."""
+    writer.writerows([row.get(k, "") for k in fieldnames] for row in rows)
+    out_f.flush()
+    os.fsync(out_f.fileno())
+
+
+async def process_row(
+    client: anthropic.AsyncAnthropic,
+    sem: asyncio.Semaphore,
+    tracker: TokenBudgetTracker,
+    row: dict,
+) -> dict:
+    """Generate the description for one row, holding a concurrency slot for the API call."""
+    async with sem:
+        try:
+            row["new_description"] = await generate_description(client, tracker, row)
+            row["generation_status"] = "success"
+        except Exception as e:
+            row["new_description"] = ""
+            row["generation_status"] = f"error: {e}"
+    return row
+
+
+async def copy_result(source: asyncio.Task, row: dict) -> dict:
+    """Fill row from the task generating an identical prompt, marking it as a duplicate."""
+    first = await source
+    row["new_description"] = first["new_description"]
+    row["generation_status"] = "dedup" if first["generation_status"] == "success" else first["generation_status"]
+    return row
+
+
+async def process_concurrent(
+    client: anthropic.AsyncAnthropic,
+    pending: Iterable[tuple[int, dict]],
+    out_f,
+    writer,
+    fieldnames: tuple[str, ...],
+) -> tuple[int, int]:
+    """Generate descriptions with up to MAX_CONCURRENCY live requests in flight, within TPM_LIMIT.
+
+    Rows are pulled from `pending` as window slots free up and written in input order.
+    Rows whose prompt matches one already in the window reuse its result instead of
+    making another request; later repeats are served by the on-disk cache.
+    """
+    sem = asyncio.Semaphore(config.MAX_CONCURRENCY)
+    tracker = TokenBudgetTracker(config.TPM_LIMIT)
+    pending = iter(pending)
+    window = deque()  # (row index, prompt key, task), oldest first
+    inflight = {}  # prompt key -> task of the first windowed row with that prompt
+
+    buffer = []
+    processed = 0
+    errors = 0
+
+    while True:
+        # Read ahead of the oldest row so the semaphore stays saturated while it finishes
+        while len(window) < config.MAX_CONCURRENCY * 4:
+            item = next(pending, None)
+            if item is None:
+                break
+            i, row = item
+            key = cache_key(row)
+            if key in inflight:
+                task = asyncio.create_task(copy_result(inflight[key], row))
+            else:
+                task = asyncio.create_task(process_row(client, sem, tracker, row))
+                inflight[key] = task
+            window.append((i, key, task))
+        if not window:
+            break
+
+        i, key, task = window.popleft()
+        if inflight.get(key) is task:
+            del inflight[key]
+        row = await task
+        title = row.get("Title", "Unknown")
+        status = row["generation_status"]
+        if status == "success":
+            processed += 1
+            print(f"[{i + 1}] {title[:60]}... OK")
+        elif status == "dedup":
+            processed += 1
+            print(f"[{i + 1}] {title[:60]}... OK (duplicate prompt)")
+        else:
+            errors += 1
+            print(f"[{i + 1}] {title[:60]}... {status}")
 
+        buffer.append(row)
+
+        # Checkpoint: save every N completed products
+        if len(buffer) >= config.SAVE_EVERY_N:
+            write_checkpoint(out_f, writer, fieldnames, buffer)
+            buffer = []
+            print(f"  -- Checkpoint saved. Processed: {processed}, Errors: {errors}")
+
+    # Flush remaining buffer
+    if buffer:
+        write_checkpoint(out_f, writer, fieldnames, buffer)
+
+    return processed, errors
+
+
+async def process_batch(
+    client: anthropic.AsyncAnthropic,
+    pending: Iterable[tuple[int, dict]],
+    out_f,
+    writer,
+    fieldnames: tuple[str, ...],
+    batch_id_path: str,
+) -> tuple[int, int]:
+    """Generate all pending descriptions through a single Message Batches job."""
+    # A batch job is submitted in one request, so every pending row is needed up front
+    pending = list(pending)
+    if not pending:
+        if os.path.exists(batch_id_path):
+            os.remove(batch_id_path)
+        return 0, 0
+
+    # Only submit one request per distinct prompt that hasn't been generated before
+    keys = {i: cache_key(row) for i, row in pending}
+    results = {}  # prompt key -> (description, status)
+    uncached = {}  # prompt key -> first uncached row with that prompt
+    for i, row in pending:
+        key = keys[i]
+        if key in results or key in uncached:
+            continue
+        cached = cache.get(key)
+        if cached is not None:
+            results[key] = (cached, "success")
+        else:
+            uncached[key] = row
+    cache_hits = sum(1 for i, _ in pending if keys[i] in results)
+    duplicates = len(pending) - cache_hits - len(uncached)
+    if cache_hits or duplicates:
+        print(f"Cache hits: {cache_hits} products, duplicate prompts: {duplicates} products")
+
+    if uncached:
+        batch_results = await run_batch(client, build_batch_requests(list(uncached.items())), batch_id_path)
+        for key in uncached:
+            description, status = batch_results.get(key, ("", "error: missing from batch results"))
+            # Only results whose custom_id matches a current prompt key reach the cache
+            if status == "success":
+                cache.set(key, description)
+            results[key] = (description, status)
 
-def append_rows(filepath: str, fieldnames: list[str], rows: list[dict]):
-    """Append processed rows to the output CSV."""
-    with open(filepath, "a", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
-        for row in rows:
-            writer.writerow(row)
+    processed = 0
+    errors = 0
+    seen = set()
+    for i, row in pending:
+        key = keys[i]
+        description, status = results[key]
+        if key in uncached:
+            if key in seen and status == "success":
+                status = "dedup"
+            seen.add(key)
+        row["new_description"] = description
+        row["generation_status"] = status
+        if status in ("success", "dedup"):
+            processed += 1
+        else:
+            errors += 1
+
+    write_checkpoint(out_f, writer, fieldnames, [row for _, row in pending])
+    # Results are on disk, so the saved batch id is no longer needed
+    if os.path.exists(batch_id_path):
+        os.remove(batch_id_path)
+    return processed, errors
+
+
+async def run(
+    api_key: str,
+    pending: Iterable[tuple[int, dict]],
+    out_f,
+    writer,
+    fieldnames: tuple[str, ...],
+    batch_id_path: str | None,
+) -> tuple[int, int]:
+    """Open the API client, process pending rows, and close the client on exit.
+
+    The client lives inside the event loop so its HTTP/2 connections are shut
+    down before asyncio.run() closes the loop. Rows go through a Message
+    Batches job unless batch_id_path is None, in which case they are sent as
+    concurrent live requests.
+    """
+    # One HTTP/2 keep-alive pool shared by all concurrent workers
+    async with httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=config.MAX_CONCURRENCY, max_connections=config.MAX_CONCURRENCY * 2),
+        http2=True,
+        timeout=config.API_TIMEOUT_SECONDS,
+    ) as http_client:
+        # call_with_backoff is the only retry policy; SDK retries would stack on top of it
+        client = anthropic.AsyncAnthropic(api_key=api_key, http_client=http_client, max_retries=0)
+        if batch_id_path is None:
+            return await process_concurrent(client, pending, out_f, writer, fieldnames)
+        return await process_batch(client, pending, out_f, writer, fieldnames, batch_id_path)
 
 
 def main():
@@ -112,24 +488,15 @@ def main():
     parser.add_argument("--input", default=None, help="Input CSV path (default: input/products.csv)")
     parser.add_argument("--output", default=None, help="Output CSV path (default: output/products_with_descriptions.csv)")
     parser.add_argument("--limit", type=int, default=None, help="Process only the first N products (for testing)")
+    parser.add_argument("--live", action="store_true", help="Use concurrent live requests instead of a Message Batches job")
     parser.add_argument("--resume", action="store_true", help="Resume from previous run, skipping already-processed SKUs")
     args = parser.parse_args()
 
     input_path = args.input or os.path.join(config.INPUT_DIR, config.DEFAULT_INPUT_FILE)
     output_path = args.output or os.path.join(config.OUTPUT_DIR, config.DEFAULT_OUTPUT_FILE)
 
-    # Validate API key
-    api_key = config.ANTHROPIC_API_KEY
-    if not api_key:
-        # Try loading from .env file in project directory
-        env_path = os.path.join(os.path.dirname(__file__), ".env")
-        if os.path.exists(env_path):
-            with open(env_path) as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith("ANTHROPIC_API_KEY="):
-                        api_key = line.split("=", 1)[1].strip().strip('"').strip("'")
-                        break
+    # Validate API key (environment variable or .env file in project directory)
+    api_key = config.load_api_key()
     if not api_key:
         print("Error: ANTHROPIC_API_KEY not set.")
         print("Set it via environment variable or create a .env file in this directory:")
@@ -143,18 +510,19 @@ def main():
         sys.exit(1)
 
     rows = load_input_csv(input_path)
-    print(f"Loaded {len(rows)} products from {input_path}")
+    print(f"Reading products from {input_path}")
 
     if args.limit:
-        rows = rows[: args.limit]
+        rows = itertools.islice(rows, args.limit)
         print(f"Limited to first {args.limit} products (test mode)")
 
     # Determine output fieldnames
-    fieldnames = [k for k in rows[0].keys() if k is not None] if rows else []
+    fieldnames = read_fieldnames(input_path)
     if "new_description" not in fieldnames:
         fieldnames.append("new_description")
     if "generation_status" not in fieldnames:
         fieldnames.append("generation_status")
+    fieldnames = tuple(fieldnames)
 
     # Handle resume
     completed_skus = set()
@@ -165,60 +533,19 @@ def main():
         # Fresh run - initialize output file
         init_output_csv(output_path, fieldnames)
 
-    client = anthropic.Anthropic(api_key=api_key)
-
     # Process products
-    buffer = []
-    processed = 0
-    skipped = 0
-    errors = 0
-    total = len(rows)
+    stats = {"skipped": 0}
+    pending = iter_pending(rows, completed_skus, stats)
 
-    for i, row in enumerate(rows):
-        sku = (row.get("Variant SKU") or "").strip()
-
-        if sku in completed_skus:
-            skipped += 1
-            continue
-
-        title = row.get("Title", "Unknown")
-        print(f"[{i + 1}/{total}] Processing: {title[:60]}...", end=" ", flush=True)
-
-        try:
-            description = generate_description(client, row)
-            row["new_description"] = description
-            row["generation_status"] = "success"
-            processed += 1
-            print("OK")
-        except anthropic.APIError as e:
-            row["new_description"] = ""
-            row["generation_status"] = f"error: {e}"
-            errors += 1
-            print(f"API ERROR: {e}")
-        except Exception as e:
-            row["new_description"] = ""
-            row["generation_status"] = f"error: {e}"
-            errors += 1
-            print(f"ERROR: {e}")
-
-        buffer.append(row)
-
-        # Checkpoint: save every N products
-        if len(buffer) >= config.SAVE_EVERY_N:
-            append_rows(output_path, fieldnames, buffer)
-            buffer = []
-            print(f"  -- Checkpoint saved. Processed: {processed}, Errors: {errors}, Skipped: {skipped}")
-
-        # Rate limiting
-        time.sleep(1.0 / config.REQUESTS_PER_SECOND)
-
-    # Flush remaining buffer
-    if buffer:
-        append_rows(output_path, fieldnames, buffer)
+    # Keep the output open for the whole run; checkpoints flush + fsync it
+    with open(output_path, "a", newline="", encoding="utf-8", buffering=1 << 16) as out_f:
+        writer = csv.writer(out_f)
+        batch_id_path = None if args.limit or args.live else output_path + ".batch"
+        processed, errors = asyncio.run(run(api_key, pending, out_f, writer, fieldnames, batch_id_path))
 
     print("\n--- Done ---")
     print(f"Processed: {processed}")
-    print(f"Skipped (already done): {skipped}")
+    print(f"Skipped (already done): {stats['skipped']}")
     print(f"Errors: {errors}")
     print(f"Output: {output_path}")
 
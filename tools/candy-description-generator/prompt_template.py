@@ -17,34 +17,30 @@ Rules:
 - Do not invent details not present in the provided information or image"""
 
 
-def build_user_prompt(row: dict) -> str:
-    """Build the text portion of the user prompt from a CSV row."""
-    parts = [f"Product title: {row.get('Title', '')}"]
-
-    if row.get("Vendor"):
-        parts.append(f"Brand/Vendor: {row['Vendor']}")
+# (CSV column, prompt label) pairs, in prompt order
+_FIELD_LABELS = (
+    ("Vendor", "Brand/Vendor"),
+    ("description", "Current description"),
+    ("units_01", "Units/sizing"),
+    ("certifications", "Certifications"),
+    ("nutritional_claims", "Nutritional claims"),
+    ("occasion", "Occasion"),
+)
 
-    if row.get("description"):
-        parts.append(f"Current description: {row['description']}")
+_MINI_KEYS = ("description_mini_01", "description_mini_02", "description_mini_03", "description_mini_04")
 
-    if row.get("units_01"):
-        parts.append(f"Units/sizing: {row['units_01']}")
 
-    if row.get("certifications"):
-        parts.append(f"Certifications: {row['certifications']}")
-
-    if row.get("nutritional_claims"):
-        parts.append(f"Nutritional claims: {row['nutritional_claims']}")
+def build_user_prompt(row: dict) -> str:
+    """Build the text portion of the user prompt from a CSV row."""
+    parts = [f"Product title: {row.get('Title', '')}"]
 
-    if row.get("occasion"):
-        parts.append(f"Occasion: {row['occasion']}")
+    for key, label in _FIELD_LABELS:
+        value = row.get(key)
+        if value:
+            parts.append(f"{label}: {value}")
 
     # Gather mini descriptions
-    minis = []
-    for i in range(1, 5):
-        key = f"description_mini_0{i}"
-        if row.get(key):
-            minis.append(row[key])
+    minis = [row[k] for k in _MINI_KEYS if row.get(k)]
     if minis:
         parts.append(f"Additional details: {' | '.join(minis)}")
 
@@ -1,6 +1,12 @@
 import os
 import io
-import json
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+import httpx
+import orjson
 from flask import Flask, request, jsonify, render_template, send_file
 from openpyxl import load_workbook, Workbook
 from anthropic import Anthropic, AuthenticationError, APIError
@@ -12,7 +18,37 @@ app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024  # 10MB limit
 
 api_key = os.environ.get("ANTHROPIC_API_KEY", "")
-client = Anthropic(api_key=api_key) if api_key else None
+# One pooled keep-alive (HTTP/2) connection pool shared by every request thread,
+# so /generate calls don't each pay for a fresh TCP+TLS handshake
+http_client = httpx.Client(
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    http2=True,
+    timeout=120.0,  # matches the gunicorn worker timeout
+)
+client = Anthropic(api_key=api_key, http_client=http_client) if api_key else None
+
+# Large /generate requests are split into chunks that are sent to Claude in parallel
+CHUNK_SIZE = 50
+MAX_CHUNK_WORKERS = 8
+
+# Deterministic fast path: plain-ASCII names that are just a strong consumer brand
+# (rule 6) plus at most one word, with no sizes/packaging (rules 7, 8), leave
+# nothing for rule 5 to shorten, so they're slugified locally instead of sent to Claude
+STOPWORDS = frozenset({"and", "with", "of", "the", "for", "in", "a", "an", "to"})
+BRAND_WHITELIST = frozenset({
+    "mike-ike", "skittles", "hersheys", "lindt", "reeses", "starburst", "haribo", "trolli",
+    "sour-patch", "jolly-rancher", "airheads", "nerds", "twizzlers", "warheads", "jelly-belly",
+    "kit-kat", "snickers", "twix", "ghirardelli", "laffy-taffy", "swedish-fish", "tootsie",
+})
+NEEDS_CLAUDE_WORDS = frozenset({
+    "candy", "candies", "gummy", "gummies", "oz", "ct", "lb", "lbs", "count", "pack", "pk",
+    "bag", "bags", "box", "boxes", "peg", "theater", "tub", "tubs", "pouch", "pouches",
+    "tin", "tins", "jar", "bulk", "case", "bar", "bars",
+})
+FAST_PATH_MAX_EXTRA_WORDS = 1  # words allowed after the brand
+
+# Leading ```/```json line and trailing ``` line of a fenced model response
+_FENCE_RE = re.compile(r"^```(?:json)?[ \t]*\n|\n```$")
 
 HANDLE_RULES_PROMPT = """You are a Shopify handle generator. Given product names, generate URL-friendly handles following these rules EXACTLY:
 
@@ -37,6 +73,89 @@ def index():
     return render_template("index.html")
 
 
+def slugify(name):
+    """Apply the mechanical handle rules: lowercase, drop apostrophes, "&" and stopwords, single hyphens."""
+    # Fold accented letters to ASCII (Crème -> creme) so they aren't treated as separators
+    s = unicodedata.normalize("NFKD", name)
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    s = s.lower().replace("&", "").replace("'", "").replace("\u2019", "")
+    return "-".join(t for t in re.split(r"[^a-z0-9]+", s) if t and t not in STOPWORDS)
+
+
+def _fast_path_handle(name):
+    """Return the handle for a name the mechanical rules fully determine, or None."""
+    # Non-ASCII names (accents, trademark symbols) are left to Claude
+    if not name.isascii():
+        return None
+    handle = slugify(name)
+    if not handle:
+        return None
+    brand = next((b for b in BRAND_WHITELIST if handle == b or handle.startswith(b + "-")), None)
+    if brand is None:
+        return None
+    words = handle.split("-")
+    if len(words) - len(brand.split("-")) > FAST_PATH_MAX_EXTRA_WORDS:
+        return None
+    if any(w in NEEDS_CLAUDE_WORDS or any(c.isdigit() for c in w) for w in words):
+        return None
+    return handle
+
+
+class AIResponseError(Exception):
+    """Claude's reply could not be parsed as a JSON array of handles."""
+
+    def __init__(self, raw):
+        super().__init__("Failed to parse AI response")
+        self.raw = raw
+
+
+def _request_handles(product_names, existing_handles):
+    """Ask Claude for handles for one chunk of product names."""
+    user_message = "Generate Shopify handles for these products:\n\n"
+    for j, name in enumerate(product_names, 1):
+        user_message += f"{j}. {name}\n"
+
+    # Only send the most recent handles to avoid prompt bloat/timeouts
+    # on large files. 200 recent handles is enough for dedup context.
+    if existing_handles:
+        recent_handles = existing_handles[-200:]
+        user_message += (
+            "\n\nAlready-used handles (must not duplicate): "
+            + ", ".join(recent_handles)
+        )
+
+    message = client.messages.create(
+        model="claude-sonnet-4-20250514",
+        max_tokens=4096,
+        messages=[{"role": "user", "content": user_message}],
+        system=[{"type": "text", "text": HANDLE_RULES_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    )
+
+    # Strip markdown code fences if present
+    response_text = _FENCE_RE.sub("", message.content[0].text.strip())
+
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        raise AIResponseError(response_text)
+
+
+def _ensure_unique(results, existing_handles):
+    """Suffix handles that collide with existing handles or an earlier result (-2, -3, ...)."""
+    used = set(existing_handles)
+    for r in results:
+        handle = base = r.get("handle")
+        if not handle:
+            continue
+        n = 2
+        while handle in used:
+            handle = f"{base}-{n}"
+            n += 1
+        r["handle"] = handle
+        used.add(handle)
+    return results
+
+
 @app.route("/generate", methods=["POST"])
 def generate_handles():
     if not client:
@@ -47,47 +166,50 @@ def generate_handles():
         return jsonify({"error": "Invalid request body"}), 400
 
     product_names = data.get("product_names", [])
-    existing_handles = data.get("existing_handles", [])
+    existing_handles = data.get("existing_handles") or []
 
     if not product_names:
         return jsonify({"error": "No product names provided"}), 400
 
     try:
-        user_message = "Generate Shopify handles for these products:\n\n"
-        for j, name in enumerate(product_names, 1):
-            user_message += f"{j}. {name}\n"
-
-        # Only send the most recent handles to avoid prompt bloat/timeouts
-        # on large files. 200 recent handles is enough for dedup context.
-        if existing_handles:
-            recent_handles = existing_handles[-200:]
-            user_message += (
-                "\n\nAlready-used handles (must not duplicate): "
-                + ", ".join(recent_handles)
-            )
-
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4096,
-            messages=[{"role": "user", "content": user_message}],
-            system=HANDLE_RULES_PROMPT,
-        )
-
-        response_text = message.content[0].text.strip()
-
-        # Strip markdown code fences if present
-        if response_text.startswith("```"):
-            lines = response_text.split("\n")
-            lines = [l for l in lines[1:] if l.strip() != "```"]
-            response_text = "\n".join(lines)
-
-        try:
-            results = json.loads(response_text)
-        except json.JSONDecodeError:
-            return jsonify({"error": "Failed to parse AI response", "raw": response_text}), 500
-
-        return jsonify({"results": results})
-
+        # Slugify the easy names locally; anything that collides with an existing
+        # handle or another product's slug still goes to Claude to disambiguate
+        fast = {i: _fast_path_handle(name) for i, name in enumerate(product_names)}
+        slug_counts = {}
+        for handle in fast.values():
+            if handle:
+                slug_counts[handle] = slug_counts.get(handle, 0) + 1
+        used = set(existing_handles)
+        fast = {i: h for i, h in fast.items() if h and h not in used and slug_counts[h] == 1}
+        remaining = [name for i, name in enumerate(product_names) if i not in fast]
+
+        ai_results = []
+        if remaining:
+            known_handles = existing_handles + list(fast.values())
+            # Chunks run concurrently, so each only sees the handles passed in;
+            # collisions between chunks are resolved after merging in order
+            chunks = [remaining[i:i + CHUNK_SIZE] for i in range(0, len(remaining), CHUNK_SIZE)]
+            with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_CHUNK_WORKERS)) as executor:
+                chunk_results = list(executor.map(lambda chunk: _request_handles(chunk, known_handles), chunks))
+            ai_results = [r for chunk in chunk_results for r in chunk]
+
+        # Merge back into input order
+        results = []
+        ai_iter = iter(ai_results)
+        for i, name in enumerate(product_names):
+            if i in fast:
+                results.append({"product_name": name, "handle": fast[i]})
+            else:
+                r = next(ai_iter, None)
+                if r is not None:
+                    results.append(r)
+        results.extend(ai_iter)
+
+        results = _ensure_unique(results, existing_handles)
+        return app.response_class(orjson.dumps({"results": results}), mimetype="application/json")
+
+    except AIResponseError as e:
+        return jsonify({"error": "Failed to parse AI response", "raw": e.raw}), 500
     except AuthenticationError:
         return jsonify({"error": "Invalid API key. Check your ANTHROPIC_API_KEY in the .env file."}), 401
     except APIError as e:
@@ -96,64 +218,66 @@ def generate_handles():
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
 
-PRODUCT_HEADERS = {"product", "product name", "product_name", "title", "name", "item", "item name", "product title", "product-name"}
-SKIP_HEADERS = {"sku", "id", "upc", "barcode", "code", "product code", "item number", "item_number", "item #", "sku #"}
+PRODUCT_HEADERS = frozenset({"product", "product name", "product_name", "title", "name", "item", "item name", "product title", "product-name"})
+SKIP_HEADERS = frozenset({"sku", "id", "upc", "barcode", "code", "product code", "item number", "item_number", "item #", "sku #"})
 
 
-def _parse_excel(file):
-    wb = load_workbook(file)
-    ws = wb.active
-    headers = {}
-    for col in range(1, ws.max_column + 1):
-        val = str(ws.cell(row=1, column=col).value or "").lower().strip()
-        headers[col] = val
-
-    product_col = None
-    detected_header = None
-
-    # First pass: look for explicit product name headers
-    for col, header in headers.items():
+def _detect_product_column(headers, sample_rows):
+    """Pick the product name column in a single pass over the normalized headers.
+
+    An explicit product header wins; otherwise the first text-heavy column that
+    isn't a known skip column, then the first non-skip column, then column 0.
+    Returns (0-based column index, detected header label).
+    """
+    fallback_col = None
+    text_col = None
+    for i, header in enumerate(headers):
         if header in PRODUCT_HEADERS:
-            product_col = col
-            detected_header = header
-            break
-
-    # Second pass: pick the first text-heavy column that isn't a known skip column
-    if product_col is None:
-        for col in range(1, ws.max_column + 1):
-            header = headers.get(col, "")
-            if header in SKIP_HEADERS:
-                continue
+            return i, header
+        if header in SKIP_HEADERS:
+            continue
+        if fallback_col is None:
+            fallback_col = i
+        if text_col is None:
             # Check if column values look like product names (longer text, not codes)
-            sample_vals = []
-            for r in range(2, min(ws.max_row + 1, 7)):
-                v = ws.cell(row=r, column=col).value
-                if v:
-                    sample_vals.append(str(v).strip())
+            sample_vals = [str(row[i]).strip() for row in sample_rows if i < len(row) and row[i] is not None]
+            sample_vals = [v for v in sample_vals if v]
             if sample_vals:
                 avg_len = sum(len(v) for v in sample_vals) / len(sample_vals)
                 if avg_len > 10:  # Product names are typically longer than SKUs/codes
-                    product_col = col
-                    detected_header = header or f"Column {col}"
-                    break
-
-    # Final fallback: first non-skip column
-    if product_col is None:
-        for col in range(1, ws.max_column + 1):
-            header = headers.get(col, "")
-            if header not in SKIP_HEADERS:
-                product_col = col
-                detected_header = header or f"Column {col}"
-                break
-        if product_col is None:
-            product_col = 1
-            detected_header = headers.get(1, "Column 1")
+                    text_col = i
 
-    product_names = []
-    for row in range(2, ws.max_row + 1):
-        val = ws.cell(row=row, column=product_col).value
-        if val and str(val).strip():
-            product_names.append(str(val).strip())
+    col = text_col if text_col is not None else fallback_col
+    if col is not None:
+        return col, headers[col] or f"Column {col + 1}"
+    return 0, headers[0] if headers else "Column 1"
+
+
+def _parse_excel(file):
+    # read_only streams the sheet XML instead of building a Cell object per cell;
+    # data_only returns cached formula results instead of the formula text
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows_iter = wb.active.iter_rows(values_only=True)
+        first_row = next(rows_iter, None)
+        if first_row is None:
+            return [], "empty"
+
+        # Only the header and a few sample rows are held for column detection;
+        # the rest of the sheet is streamed straight into the name list
+        headers = [str(h or "").lower().strip() for h in first_row]
+        sample_rows = list(islice(rows_iter, 5))
+        product_col, detected_header = _detect_product_column(headers, sample_rows)
+
+        product_names = []
+        for row in chain(sample_rows, rows_iter):
+            val = row[product_col] if product_col < len(row) else None
+            if val is not None:
+                val = str(val).strip()
+                if val:
+                    product_names.append(val)
+    finally:
+        wb.close()
 
     return product_names, detected_header
 
@@ -167,37 +291,7 @@ def _parse_csv(file):
         return [], "empty"
 
     headers = [h.lower().strip() for h in rows[0]]
-
-    product_col = None
-    detected_header = None
-
-    for i, header in enumerate(headers):
-        if header in PRODUCT_HEADERS:
-            product_col = i
-            detected_header = header
-            break
-
-    if product_col is None:
-        for i, header in enumerate(headers):
-            if header in SKIP_HEADERS:
-                continue
-            sample_vals = [rows[r][i] for r in range(1, min(len(rows), 6)) if i < len(rows[r]) and rows[r][i].strip()]
-            if sample_vals:
-                avg_len = sum(len(v) for v in sample_vals) / len(sample_vals)
-                if avg_len > 10:
-                    product_col = i
-                    detected_header = header or f"Column {i + 1}"
-                    break
-
-    if product_col is None:
-        for i, header in enumerate(headers):
-            if header not in SKIP_HEADERS:
-                product_col = i
-                detected_header = header or f"Column {i + 1}"
-                break
-        if product_col is None:
-            product_col = 0
-            detected_header = headers[0] if headers else "Column 1"
+    product_col, detected_header = _detect_product_column(headers, rows[1:6])
 
     product_names = []
     for row in rows[1:]:
@@ -236,18 +330,24 @@ def download_file():
     data = request.get_json()
     results = data.get("results", [])
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Shopify Handles"
-    ws.append(["Product Name", "Handle"])
+    header = ["Product Name", "Handle"]
+    rows = [[r["product_name"], r["handle"]] for r in results]
 
-    for r in results:
-        ws.append([r["product_name"], r["handle"]])
+    # Auto-size columns from the raw values. write_only sheets emit column
+    # widths with the first row, so they must be set before any append.
+    max_lens = [len(h) for h in header]
+    for row in rows:
+        for i, val in enumerate(row):
+            max_lens[i] = max(max_lens[i], len(str(val or "")))
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Shopify Handles")
+    for letter, max_len in zip("AB", max_lens):
+        ws.column_dimensions[letter].width = min(max_len + 2, 60)
 
-    # Auto-size columns
-    for col in ws.columns:
-        max_len = max(len(str(cell.value or "")) for cell in col)
-        ws.column_dimensions[col[0].column_letter].width = min(max_len + 2, 60)
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
 
     buf = io.BytesIO()
     wb.save(buf)
@@ -257,7 +357,7 @@ def download_file():
         buf,
         as_attachment=True,
         download_name="shopify_handles.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.xml",
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )
 
 